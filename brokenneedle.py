@@ -10,6 +10,13 @@ debug = 0
 # 1 mostly shows the tests done
 # 2 display basic output, mostly for subsetting diagnostics
 # 3 is very verbose about everything
+# in the functions, the checks are done as "if __debug__ and debug > N": it costs nothing more,
+# and with python -O they are removed entirely from the hot loops, as the asserts are
+
+# extra sanity checks (asserts) on the matches, to help with debugging the algorithm itself:
+# they are not needed to find the needles, and some are O(n), so they are off by default
+# (and always off with python -O)
+validate = False
 
 # The needles to be found, and replaced by a geographical code
 needlesgeo= {
@@ -54,42 +61,6 @@ piecedistancetolerance = 4
 piecesizerequirement = 1
 
 
-# flatten an array of array into an array: cool version with iterator
-def _flatten_generator(iterable):
-    try:
-        iterator = iter(iterable)
-    except TypeError:
-        yield iterable
-    else:
-        for element in iterator:
-            yield from flatten1(element)
-
-
-def flatten1(iterable):
-    if isinstance(iterable, str):
-        return [iterable]
-    else:
-        return list(_flatten_generator(iterable))
-
-
-# but this is far easier to understand and maintain, while
-# the goal is not to do fancy code using every feature python
-# supports, but write code that most people can tweak and improve
-def flatten2(input_array):
-    if isinstance(input_array, str):
-        return [input_array]
-    else:
-        result_array = []
-        for element in input_array:
-            if isinstance(element, int):
-                result_array.append(element)
-            elif isinstance(element, str):
-                result_array.append(element)
-            elif isinstance(element, list):
-                result_array += flatten2(element)
-        return result_array
-
-
 # main algorithm: the "broken needle": generalizes and expands a regex solution:
 # for a set of candidate needles (signal), and a haystack (signal + noise)
 # returns both the array of matches (for each needle: start,length,stop)
@@ -126,242 +97,344 @@ def flatten2(input_array):
 # and naive approaches ("ORLEANS orphenates NEW so pick the needle NEW ORLEANS
 # instead of just ORLEANS for the haystack NEW ORLEANS")
 
-# WONTFIX: could memoize by building a dict of broken needle positions
-# However, complicated and memory intensive, while the dictionaries are small
-# so not necessarily faster (+ premature optimization is the root of all evil)
-
-def brokenneedlealgorithm(needles, haystack):
-    # returns:
-    found = {}  # dict of arrays: which broken needles were found:
-    # at which starting positions, for how long, at which ending position
-    # the ending position is required as the hay may impact calculation for subsetting needles
-    alternatives = [None] * len(haystack)  # alternative needles per position: initially empty
-
-    # first, filter the needles based on a size requirement:
-    # useful if, for example, one-character pieces or ASCII punctuation should be removed
-
-    # save the previous needle to break the loop, as alternatives may cause us to keep trying
-    previousneedle = None
-    # loop on each needle, then on each of its pieces trying to find a full set of pieces
+# The pieces positions are memoized: instead of scanning the haystack again with find()
+# for every piece of every needle at every retry, the haystack is scanned once per distinct
+# piece to build a dict of where each piece can be found, then only that dict is searched
+#
+# This is because the cost is in moving through the haystack, not in the few comparisons
+# done on the positions: with about 20 needles broken into about 2 pieces each, the haystack
+# used to be read about 40 times over (even more with the retries), for the same result.
+# So the work is done in this order:
+# 1) one pass over the haystack for each distinct piece, to get the positions of the pieces
+# 2) then only integer logic on these positions lists (order, tolerance, retries), that are
+#    much smaller than the haystack: the haystack itself is never read again
+# Any further optimization should keep to this split, and be done on the second part.
+#
+# To go faster, run it with PyPy: it's all str.find, dicts, lists and integers, which is what
+# its JIT is good at, while numba can't do much with strings and would fall back to object mode.
+# To keep it JIT friendly, the hot loops keep stable shapes: found is always a dict of lists
+# of [start, len, stop] ints, the lookups use dict.get instead of try/except, and there is no
+# per element isinstance check or C extension on the hot path.
+
+import sys
+from bisect import bisect_left, bisect_right
+from functools import lru_cache
+
+# break a needle on the known separator that is lost/damaged in the haystack, and filter
+# the pieces based on a size requirement: returns (pieces, pieces lengths), where the pieces
+# are already lowercase, as all the comparisons are case insensitive
+# This only depends on the needle and the size requirement, so it's only done once for each
+# even when looking for the same needles in many haystacks
+# The cache is bounded, as the needles can come from the caller: when they keep changing,
+# only the most recently used ones are kept instead of growing without limit
+# WONTFIX: the needle could be broken further if spaces are not the only issue
+# eg if the ASCII chars like -/({[ etc are also damaged, only keep a-zA-Z0-9
+@lru_cache(maxsize=1024)
+def _breakneedle(needle, sizerequirement):
+    # filter the pieces based on a size requirement: useful if, for example,
+    # one-character pieces or ASCII punctuation should be removed
+    brokenneedle = tuple(x for x in str.split(needle, " ") if len(x) > sizerequirement)
+    # the lengths are those of the pieces as they are in the needle
+    return tuple(x.lower() for x in brokenneedle), tuple(len(x) for x in brokenneedle)
+
+
+# break the needles, once and for all, before looking for them:
+# returns a list of (needle, pieces, pieces lengths)
+def _breakneedles(needles):
+    brokenneedles = []
     for needle in needles.keys():
-        if debug > 1:
-            print("Needle = " + str(needle))
-        piecesfound = {}  # dict: for every piece of a needle, where in starts, how long, stops
-        # WONTFIX: for a needle, how long is different from needle stop position due to hay
-        # this is not the case for a piece of a needle: startpos+howlong=stoppos, fully redundant
-        # however, we keep the end position there for consistency
-        needlestartpos = None  # where the needle begins (ie beginning of the first piece)
-        needlestoppos = None  # where the needle ends (ie end of the last piece)
-        # truly known when we have all the pieces, then flushed, so we keep separately what was the former one
-        # so that we can detect when we are done parsing while also allowing for retries
-        # meaning we can't easily use a for loop, but have to use a while loop instead
-        previousneedlestoppos = None
-
-        # break the needle on the known separator that is lost/damaged in the haystack
-        # WONTFIX: the needle could be broken further if spaces are not the only issue
-        # eg if the ASCII chars like -/({[ etc are also damaged, only keep a-zA-Z0-9
-        brokenneedle = str.split(needle, " ")
-
-        # filter with an list comprehension, which may be too fancy?
-        # TODO: another reason to consider doing a separate fonction: things like
-        # len(brokenneedle)>piecesizerequirement etc. could be beneficial
-        brokenneedle = [x for x in brokenneedle if len(x) > piecesizerequirement]
-
-        # due to the above, there could be nothing left due to the filter, so tell us about that
-        if len(brokenneedle) < 1:
-            if debug > 1:
-                print("Not checking for the fully filtered needle: " + str(needle))
-            else:
-                # if the array is not empty (which case would be skipped at the while), tell us:
-                if brokenneedle:
-                    print("Currently checking for this needle, broken into size-filtered pieces:")
-                    print(brokenneedle)
-
-        # we may give up early, like if we wont have all the needle pieces in order
-        # or we may try again after success, if all the pieces suggest one or more subset
-        tryfindingbrokenneedle = True
-        tryagainwhere = 0
-
-        p = 0  # current piece number being handled for a given needle
-        piecestartpos = None  # position in the haystack where the piece begins
-        piecestoppos = None  # position in the haystack where the piece ends
-
-        # this is not a for loop but a while, to allow for extra things like retrying
-        while tryfindingbrokenneedle is True and brokenneedle:
-            if tryagainwhere:
-                if debug>1:
-                    print ("tryagainwhere=" + str(tryagainwhere))
-                if debug>2:
-                    print ("visible haystack from there:")
-                    print (str(haystack)[tryagainwhere:])
-            # stop if we are on the last needle without retrying again further
-            if previousneedle == needle:
-                if not tryagainwhere > 0:
-                    break
-            # attention: you can do off by one between brokenneedle and p
-            if debug > 1:
-                print(str("when broken, length of needle=") + str(len(brokenneedle)))
-            for piece in brokenneedle:
-                if tryagainwhere > 0:
-                    # All the comparisons are case insensitive ; the simplest way to do that
-                    # is to compare both after converting each to lowercase!
-                    # Also, in case the needle case matters (ex: CamelCase), this restores it into the haystack
-                    if p ==0:
-                        piecestartpos = haystack.lower().find(piece.lower(), tryagainwhere)
-                    else:
-                        # tryagainwhere should not replace where the previous piece was found
-                        # it's just a floor, if the previous piece is above it, use it:
-                        previouspiecestartpos=piecesfound[p-1][0]
-                        piecestartpos = haystack.lower().find(piece.lower(), max(previouspiecestartpos,tryagainwhere))
-                else:
-                    if p==0:
-                        piecestartpos = haystack.lower().find(piece.lower())
-                    else:
-                        previouspiecestartpos = piecesfound[p-1][0]
-                        piecestartpos = haystack.lower().find(piece.lower(), previouspiecestartpos)
-
-                # later also taken as the tempory end of the needle, until we have found all of its pieces
-                piecestoppos = piecestartpos + len(piece) - 1
-
-                piecetolerance = False  # by default, fail the pieces found unless the tolerance is met
-                # this is used at the moment for the following conditions:
-                # 1) a single missing piece immediately disqualifies the potential needle
-                #
-                # DEPRECATED:2) we are discovering again the beginning of a needle found before at this exact position (!!!)
-                # This 2nd condition should NO LONGER be necessary given the algorithm logic
-                # however it *WAS* happening until the code was extended to handle several edgecases
-                # so it is kept as a reminder
-                #
-                # 3) the piece is ordered within tolerance, taken as meaning 2 separate things:
-                # 3a) basic: while taking tolerance into account, the pieces are not too far apart from each other
-                # 3b) better: if more than one piece, they are all in order (NEW YORK is ok, YORK NEW is not!)
-
-                if p == 0:
-                    # the beginning of the first ever piece (p=0) of a needle
-                    # defines where this needle itself starts at (was: None)
-                    needlestartpos = piecestartpos
-
-                # this is condition 1)
-                if piecestartpos == -1:
-                    tryfindingbrokenneedle = False
-                    break  # if not found: break out of for.piece to resume the for.needle
+        pieceslower, piecelens = _breakneedle(needle, piecesizerequirement)
+
+        # due to the filter, there could be nothing left, so tell us about that
+        if len(piecelens) < 1:
+            if __debug__ and debug > 1:
+                print(f"Not checking for the fully filtered needle: {needle}")
+        else:
+            brokenneedles.append((needle, pieceslower, piecelens))
+    return brokenneedles
+
+
+# for each distinct piece (already lowercase, as all the comparisons are case insensitive)
+# returns the sorted list of every position where it starts in the haystack,
+# overlapping ones included, exactly what repeated calls to find() would return
+def _piecepositions(brokenneedles, haystack):
+    haystacklower = haystack.lower()
+    # a pure ascii haystack (the usual case) is searched as bytes: the positions are the same,
+    # and bytes.find does not have to deal with the wider str representations
+    # anything else is searched as a str
+    # str.isascii() would need python 3.7, so the encoding is simply tried
+    try:
+        haystacklower = haystacklower.encode("ascii")
+        haystackascii = True
+    except UnicodeEncodeError:
+        haystackascii = False
+    # the bound method is looked up once instead of at every call
+    haystackfind = haystacklower.find
+    piecepositions = {}
+    for needle, pieceslower, piecelens in brokenneedles:
+        for piecelower in pieceslower:
+            if piecelower not in piecepositions:
+                positions = []
+                if not haystackascii:
+                    piecesearch = piecelower
                 else:
-                    # show what we have for now
-                    if debug > 2:
-                        print("all needles found currently:" + str(found))
-                        print("for needle: " + needle + " @ piece:" + piece)
-                        print("all pieces found currently:" + str(piecesfound))
-                        print("a piece was just found @ " + str(piecestartpos) + "-" + str(piecestoppos))
-
-                    # this is condition 2) as it shouldn't happen anymore, now is an assert
-                    # to cause a bug and force a reinspection of this code
                     try:
-                        alreadyknownneedles = found[piece]
-                    except KeyError:
-                        alreadyknownneedles = []
-                        pass
-                    assert (needlestartpos not in alreadyknownneedles)
-
-                    # this is condition 3: pieces are in order
-                    if p == 0:
-                        # automatically passed for more than one piece
-                        piecetolerance = True
-                    if p > 0:
-                        # Condition 3a:  making sure the pieces are not too far apart
-                        # meaning the end of a previous piece + tolerance must be >= start of a new piece
-                        # item 0 is the start, item 1 is the len
-                        if debug > 2:
-                            print(str(piecesfound[p-1][0]) + "+" + str(piecesfound[p-1][1]) + "+" + str(piecedistancetolerance) + "?>=" + str(piecestartpos))
-                        if not piecesfound[p-1][0] + piecesfound[p-1][1] +int(piecedistancetolerance) >= piecestartpos:
-                            if debug >2:
-                                print("new piece distance checks breaks tolerance, rejecting")
-                        else:
-                            # Condition 3b: if all the known pieces are in order
-                            orderfound = []
-                            for pp in piecesfound:
-                                orderfound.append(piecesfound[pp][0])
-                            # then the new one
-                            orderfound.append(piecestartpos)
-                            if not sorted(orderfound) == orderfound:
-                                if debug>2:
-                                    print("we would break the logical order if adding, so rejecting " + str(piece))
-                                piecetolerance = False
-                            else:
-                                piecetolerance = True
-
-                    # if the piece has passed all the requirements
-                    if piecetolerance is True:
-                        if debug > 2:
-                            print("adding piece that passes all requirements :" + str(piece))
-                            print("p=" + str(p) + ", @=" + str(piecestartpos) + ":" + str(piecestoppos))
-
-                        # add to the dict of pieces where this one was found
-                        piecesfound[p] = [piecestartpos, len(piece), piecestoppos]
-
-                        if debug > 2:
-                            print("piecesfound current:" + str(piecesfound))
-
-                        # increment the piece counter
-                        p = p + 1
-                        # WARNING: this can cause an off by one error if p not decremented
-                        # in the end, ie when we will have found all pieces
-                    else:
-                        if debug > 2:
-                            print("rejecting piece for whatever condition fail:" + str(piece))
-
-                        # if it fails the requirements, keep trying, but past the issue:
-                        # tryagainwhere should not be 0 if some pieces were already found:
-                        # can assemble where the good pieces where found, then guess where to restart past
-                        # a simple guess is the max +1
-                        pp=p-1
-                        assemblewherepiecefound=[]
-                        while pp > -1:
-                            try:
-                                assemblewherepiecefound.append(piecesfound[pp][0])
-                            except IndexError:
-                                pass
-                            pp=pp-1
-                        tryagainwhere = max(assemblewherepiecefound)
-                        tryagainwhere = tryagainwhere + 1
-                        if debug>2:
-                            print("Choice of where to try again=" + str(tryagainwhere) + " given:" )
-                            print(str(assemblewherepiecefound))
-                        # then flush all these failing pieces
-                        piecesfound={}
-                        # restart from scratch
-                        p=0
-                        # and try again at this further spot by breaking on the for to go back to the while
-                        break
-
-            # when we indeed have found all of its pieces
-            if len(piecesfound) == len(brokenneedle):
-                # first, prevent the off-by-one on p
-                p = p - 1
-                # given this previous off-by-one bug, do some further sanity checks
-                # like if the starting point is a number (!)
-                if debug > 1:
-                    print("last piece is p=" + str(p))
-                if debug > 2:
-                    print("needlestartpos=" + str(needlestartpos))
-                    print("piecestartpos=" + str(piecestartpos))
-
-                # sanity checks:
-                assert isinstance(needlestartpos, int)
-                assert isinstance(piecestartpos, int)
-                # check if the starting point means something (!)
+                        piecesearch = piecelower.encode("ascii")
+                    except UnicodeEncodeError:
+                        # a non ascii piece can never be found in an ascii haystack
+                        piecesearch = None
+                if piecesearch is not None:
+                    positionsappend = positions.append
+                    position = haystackfind(piecesearch)
+                    while position != -1:
+                        positionsappend(position)
+                        position = haystackfind(piecesearch, position + 1)
+                piecepositions[piecelower] = positions
+    return piecepositions
+
+
+# same as find(), but using the memoized positions of a piece:
+# the first position of the piece at or after the floor, or -1 if there is none
+def _piecefind(positions, floor):
+    i = bisect_left(positions, floor)
+    if i < len(positions):
+        return positions[i]
+    return -1
+
+
+# The matching of a broken needle, once its pieces positions are known, is only integer
+# arithmetic on these positions: there's no need to know which needle it is, or to look
+# at the haystack at all. So it is done separately, on these integers only: for each piece
+# of the needle, where it can be found (positions) and how long it is (piecelens).
+# Returns the list of the (start, stop) of every match of the needle.
+def _brokenneedlematches(positions, piecelens):
+    npieces = len(positions)  # how many pieces the needle was broken into
+    matches = []
+    piecesfound = []  # list: for every piece of a needle, a tuple of where in starts, how long, stops
+    # neither list is ever replaced (piecesfound is only cleared), so their append can be looked up once
+    matchesappend = matches.append
+    piecesfoundappend = piecesfound.append
+    # the tolerance is already an int, and is read for every piece so keep it local
+    tolerance = piecedistancetolerance
+    # WONTFIX: for a needle, how long is different from needle stop position due to hay
+    # this is not the case for a piece of a needle: startpos+howlong=stoppos, fully redundant
+    # however, we keep the end position there for consistency
+
+    # the only state kept between the attempts is where to try again: a floor for all the pieces,
+    # that only ever moves forward, either past a rejected piece or past a match (like for subsetting needles)
+    # each attempt then looks for all the pieces in order, and either:
+    # - gives up for good if a piece can't be found anymore (return)
+    # - tries again past the issue if a piece is not within tolerance (break)
+    # - or has found all the pieces: a match (else of the for)
+    tryagainwhere = 0
+
+    while True:
+        if tryagainwhere:
+            if __debug__ and debug>1:
+                print(f"tryagainwhere={tryagainwhere}")
+        if __debug__ and debug > 1:
+            print(f"when broken, length of needle={npieces}")
+        piecesfound.clear()
+        # p is the current piece number being handled for a given needle
+        for p, piecepositions in enumerate(positions):
+            # All the comparisons are case insensitive, which was taken care of when finding
+            # the pieces positions: in case the needle case matters (ex: CamelCase), this
+            # restores it into the haystack
+            if p ==0:
+                piecestartpos = _piecefind(piecepositions, tryagainwhere)
+            else:
+                # tryagainwhere should not replace where the previous piece was found
+                # it's just a floor, if the previous piece is above it, use it:
+                previouspiecestartpos, previouspiecelen, _ = piecesfound[-1]
+                piecestartpos = _piecefind(piecepositions, max(previouspiecestartpos,tryagainwhere))
+
+            # later also taken as the tempory end of the needle, until we have found all of its pieces
+            piecestoppos = piecestartpos + piecelens[p] - 1
+
+            # the pieces found are rejected unless the tolerance is met
+            # this is used at the moment for the following conditions:
+            # 1) a single missing piece immediately disqualifies the potential needle
+            #
+            # DEPRECATED:2) we are discovering again the beginning of a needle found before at this exact position (!!!)
+            # This 2nd condition should NO LONGER be necessary given the algorithm logic
+            # however it *WAS* happening until the code was extended to handle several edgecases
+            # so it is kept as a reminder: it's now asserted when the match is added to the needles found
+            #
+            # 3) the piece is ordered within tolerance, taken as meaning 2 separate things:
+            # 3a) basic: while taking tolerance into account, the pieces are not too far apart from each other
+            # 3b) better: if more than one piece, they are all in order (NEW YORK is ok, YORK NEW is not!)
+
+            # this is condition 1): as the floor only moves forward, there won't be any more match
+            if piecestartpos == -1:
+                return matches
+
+            # show what we have for now
+            if __debug__ and debug > 2:
+                print(f"all matches found currently:{matches}")
+                print(f"@ piece:{p}")
+                print(f"all pieces found currently:{piecesfound}")
+                print(f"a piece was just found @ {piecestartpos}-{piecestoppos}")
+
+            # this is condition 3: pieces are in order, automatically passed for the first piece
+            if p > 0:
+                # Condition 3a:  making sure the pieces are not too far apart
+                # meaning the end of a previous piece + tolerance must be >= start of a new piece
+                # using the start and the len of the previous piece
+                if __debug__ and debug > 2:
+                    print(f"{previouspiecestartpos}+{previouspiecelen}+{piecedistancetolerance}?>={piecestartpos}")
+                if not previouspiecestartpos + previouspiecelen + tolerance >= piecestartpos:
+                    if __debug__ and debug >2:
+                        print("new piece distance checks breaks tolerance, rejecting")
+                    piecetolerance = False
+                # Condition 3b: if all the known pieces are in order
+                # they already were before the new one (or it would have been rejected)
+                # so only the new one has to be checked against the previous one
+                elif piecestartpos < previouspiecestartpos:
+                    if __debug__ and debug>2:
+                        print(f"we would break the logical order if adding, so rejecting piece {p}")
+                    piecetolerance = False
+                else:
+                    piecetolerance = True
+
+                if not piecetolerance:
+                    if __debug__ and debug > 2:
+                        print(f"rejecting piece for whatever condition fail:{p}")
+
+                    # if it fails the requirements, keep trying, but past the issue:
+                    # can assemble where the good pieces where found, then guess where to restart past
+                    # a simple guess is the max +1, and as the good pieces are in order, the max is
+                    # simply the last one (the first piece always passes, so there is at least one)
+                    tryagainwhere = previouspiecestartpos + 1
+                    if __debug__ and debug>2:
+                        print(f"Choice of where to try again={tryagainwhere} given:")
+                        print([row[0] for row in piecesfound])
+                    # and try again at this further spot by breaking on the for to go back to the while
+                    break
+
+            # the piece has passed all the requirements
+            if __debug__ and debug > 2:
+                print(f"adding piece that passes all requirements :{p}")
+                print(f"p={p}, @={piecestartpos}:{piecestoppos}")
+
+            # add where this one was found to the list of pieces found
+            piecesfoundappend((piecestartpos, piecelens[p], piecestoppos))
+
+            if __debug__ and debug > 2:
+                print(f"piecesfound current:{piecesfound}")
+
+        # when we indeed have found all of its pieces
+        else:
+            # the beginning of the first piece defines where this needle itself starts at
+            needlestartpos = piecesfound[0][0]
+            if __debug__ and debug > 1:
+                print(f"last piece is p={p}")
+            if __debug__ and debug > 2:
+                print(f"needlestartpos={needlestartpos}")
+                print(f"piecestartpos={piecestartpos}")
+
+            # sanity checks: check if the starting point means something (!)
+            if __debug__ and validate:
                 assert needlestartpos >= 0
                 assert needlestartpos <= piecestartpos
 
-                # needlestartpos will be < last piece start position as min(len(piece))=1
-                if debug>2:
-                      print("needlestoppos=piecestoppos=" + str(piecestoppos))
+            # needlestartpos will be < last piece start position as min(len(piece))=1
+            if __debug__ and debug>2:
+                  print(f"needlestoppos=piecestoppos={piecestoppos}")
 
-                # check if the end point is plausible given the tolerance
-                needlestoppos = piecestoppos
+            # check if the end point is plausible given the tolerance
+            needlestoppos = piecestoppos
 
-                # stricly inferior: no size 0 needle!
+            # stricly inferior: no size 0 needle!
+            if __debug__ and validate:
                 assert needlestartpos<needlestoppos
 
+            # at this stage, we can assume a match
+            matchesappend((needlestartpos, needlestoppos))
+
+            # when we indeed have found all of the pieces and processed them,
+            # we may then try again if there are more matches of the needle
+            # broken pieces "right after" this needle (like for subsetting needles)
+            # define "right after" as the end of this piece +1
+            if __debug__ and debug > 1:
+                print(f"Do we want to try again past {piecestoppos} where it was found?")
+            # first, a quick check that doesn't need any search: if a piece last position is
+            # not past this needle, the pieces can't all be found again so don't even look
+            if any(nextpiecepositions[-1] <= piecestoppos for nextpiecepositions in positions):
+                if __debug__ and debug > 1:
+                    print(f"Will not try again as some piece is not found past {piecestoppos}")
+                return matches
+            previousnextpiecepos = -1
+            for nextp, nextpiecepositions in enumerate(positions):
+                nextpiecepos = _piecefind(nextpiecepositions, piecestoppos + 1)
+                # if there are all the pieces, worth trying again!
+                # But check if they are in order: as we stop at the first one out of order,
+                # comparing with the previous one is enough
+                nextpieceordered = nextpiecepos >= previousnextpiecepos
+                previousnextpiecepos = nextpiecepos
+                if not nextpieceordered:
+                    if __debug__ and debug>1:
+                        print("Next pieces are not ordered correctly")
+                if not (nextpiecepos > 0) or not nextpieceordered:
+                    if __debug__ and debug > 1:
+                        print(f"Will not try again because {nextpiecepos} @ piece {nextp}")
+                    return matches
+                if __debug__ and debug > 1:
+                    print(f"Ready to try again past {piecestoppos+1} @ {nextpiecepos} @ piece {nextp}")
+            tryagainwhere = piecestoppos+1
+            if __debug__ and debug > 1:
+                print("Now trying again after flushing")
+
+
+# withalternatives: whether to also build the alternatives per position (the default)
+# as it's one list per position, it's the costliest part: when only the needles found
+# are needed, give False to skip it, then alternatives will be None
+def brokenneedlealgorithm(needles, haystack, withalternatives=True):
+    # returns:
+    found = {}  # dict of arrays: which broken needles were found:
+    # at which starting positions, for how long, at which ending position
+    # the ending position is required as the hay may impact calculation for subsetting needles
+    haystacklen = len(haystack)
+    if withalternatives:
+        alternatives = [None] * haystacklen  # alternative needles per position: initially empty
+    else:
+        alternatives = None
+
+    # first, break the needles into pieces filtered based on a size requirement
+    brokenneedles = _breakneedles(needles)
+
+    # where each piece can be found, computed only once for all the needles
+    piecepositions = _piecepositions(brokenneedles, haystack)
+
+    # the matches only depend on the pieces: the work done for a needle is shared with every
+    # other needle broken into the same pieces (ex: York and YORK, or A NEW and NEW when A is
+    # filtered), while needles only sharing some pieces (NEW and NEW YORK) already share
+    # where these pieces are found
+    matchesbypieces = {}
+
+    # loop on each needle, then on each of its matches, once the broken needle algorithm
+    # has found the full sets of pieces
+    for needle, pieceslower, piecelens in brokenneedles:
+        if __debug__ and debug > 1:
+            print(f"Needle = {needle}")
+        needlelen = len(needle)
+        matches = matchesbypieces.get((pieceslower, piecelens))
+        if matches is None:
+            positions = [piecepositions[piecelower] for piecelower in pieceslower]
+            # a piece that is nowhere in the haystack (like for most needles) means no match at all
+            if all(positions):
+                matches = _brokenneedlematches(positions, piecelens)
+            else:
+                if __debug__ and debug > 1:
+                    print("Some pieces are not in the haystack, not even trying")
+                matches = []
+            matchesbypieces[(pieceslower, piecelens)] = matches
+        elif __debug__ and debug > 1:
+            print("Same pieces as a previous needle, reusing its matches")
+
+        for needlestartpos, needlestoppos in matches:
+            # sanity check on the hay, when validating
+            if __debug__ and validate:
+                p = len(piecelens) - 1  # the last piece number
                 # TODO: there should be a more precise accounting of the hay
                 #
                 # until then, estimate to min(1,somehay times the number of pieces)
@@ -375,110 +448,68 @@ def brokenneedlealgorithm(needles, haystack):
                 # Goal of this assertion: making sure we haven't included pieces that are too far apart
                 # but more or less consecutive even when accounting for the hay
                 # Alternatively, could also do psomehay < actualhay
-                if debug > 2:
-                    print("needle start at " + str(needlestartpos))
-                    print("needle end at " + str(needlestoppos))
-                    print("needle made of " + str(p) + " pieces with somehay=" + str(somehay))
-                    print("min(1,p*somehay)=psomehay=" + str(psomehay))
+                if __debug__ and debug > 2:
+                    print(f"needle start at {needlestartpos}")
+                    print(f"needle end at {needlestoppos}")
+                    print(f"needle made of {p} pieces with somehay={somehay}")
+                    print(f"min(1,p*somehay)=psomehay={psomehay}")
                     print("logic test applied:")
-                    print(str(needlestoppos) + " - " + str(needlestartpos) + " ?<= " + str(len(needle)) + " + p*somehay=" +  str(p*somehay))
-                assert (needlestoppos-needlestartpos  <=  len(needle) + psomehay )
-
-                # at this stage, we can assume a match so populate the solutions
-                # first, check if this needle was already found elsewhere
-                try:
-                    # arg 0 is the needlestart
-                    alreadyfound = flatten2(found[needle][0])
-                except KeyError:
-                    alreadyfound = None
-                    pass
-
-                # array of arrays, so the new needle itself is an array of strings, not ints, as a precaution
-                newlyfoundneedle=[str(needlestartpos), str(len(needle)), str(needlestoppos)]
-
-                if alreadyfound is None:
-                    # making a dict of arrays
-                    found[needle] = [ newlyfoundneedle ]
-                    if debug > 2:
-                        print("Newly found needle added")
+                    print(f"{needlestoppos} - {needlestartpos} ?<= {needlelen} + p*somehay={p*somehay}")
+                assert (needlestoppos-needlestartpos  <=  needlelen + psomehay )
+
+            # at this stage, we can assume a match so populate the solutions
+            # first, check if this needle was already found elsewhere
+            # found[needle] is already a list of [start, len, stop]: get is a single lookup
+            alreadyfound = found.get(needle)
+
+            # array of arrays, so the new needle itself is an array of ints: start, len, stop
+            newlyfoundneedle=[needlestartpos, needlelen, needlestoppos]
+
+            if alreadyfound is None:
+                # making a dict of arrays
+                found[needle] = [ newlyfoundneedle ]
+                if __debug__ and debug > 2:
+                    print("Newly found needle added")
+            else:
+                if __debug__ and debug > 2:
+                    print("Needle found in several position, indicating a subset issue requiring parsing alternatives")
+                    print(alreadyfound)
+
+                # Should not happen at this point given prior tests, so assert that when validating!
+                # (this was the condition 2 when looking for the pieces) arg 0 is the needlestart
+                # as the matches of a needle come in order, it's enough to check the last one
+                if __debug__ and validate:
+                    assert (needlestartpos > alreadyfound[-1][0])
+
+                # then add it to the dict of arrays
+                alreadyfound.append(newlyfoundneedle)
+
+                if __debug__ and debug > 2:
+                    print("This needle know positions are now: ")
+                    print(found[needle])
+
+            # also populate the alternatives by parsing the range and appending if needed
+            # unless they are not wanted, like when only the needles found will be used
+            if withalternatives:
+                if __debug__ and debug > 1:
+                    print(f"Populating alternatives from {needlestartpos} to {needlestoppos}")
+                # do not try to go beyond the end of line! this is because on the very last match,
+                # needlestoppos could be at the end of the haystack
+                alternativesstop = min(needlestoppos + 1, haystacklen)
+                span = alternativesstop - needlestartpos
+                if alternatives[needlestartpos:alternativesstop].count(None) == span:
+                    # nothing there yet, which is the common case: fill the whole span at once
+                    # with a slice, but each position needs its own list as they may be appended to later
+                    alternatives[needlestartpos:alternativesstop] = [[needle] for _ in range(span)]
                 else:
-                    if debug > 2:
-                        print("Needle found in several position, indicating a subset issue requiring parsing alternatives")
-                        print(alreadyfound)
-
-                    # Should not happen at this point given prior tests, so assert that !
-                    assert (needlestartpos not in alreadyfound)
-
-                    # then add it to the dict of arrays
-                    found[needle].append(newlyfoundneedle)
-
-                    if debug > 2:
-                        print("This needle know positions are now: ")
-                        print(str(found[needle]))
-
-                # also populate the alternatives by parsing the range and appending if needed
-                cur = needlestartpos
-                if debug > 1:
-                    print("Populating alternatives from " + str(cur) + " to " + str(needlestoppos))
-                while cur <= needlestoppos:
-                    currentalt = alternatives[cur]
-                    if currentalt is None:
-                        alternatives[cur] = [needle]
-                    else:
-                        # there is already something else
-                        ac = alternatives[cur]
-                        acf = flatten1(ac)
-                        if needle not in acf:
-                            acf.append(needle)
-                            alternatives[cur] = acf
-                    cur = cur + 1
-                    #  do not try to go beyond the end of line!
-                    if cur == len(haystack):
-                        # this is because on the very last match,
-                        # needlestoppos could be at the end of the haystack
-                        break
-
-                # when we indeed have found all of the pieces and processed them,
-                # we may then try again if there are more matches of the needle
-                # broken pieces "right after" this needle (like for subsetting needles)
-                # define "right after" as the end of this piece +1
-                if debug > 1:
-                    print("Do we want to try again past " + str(piecestoppos) + " where it was found?")
-                nextpiecepos = 0
-                nextpieceorder= []
-                for nextpiece in brokenneedle:
-                    nextpiecepos = haystack.lower().find(nextpiece.lower(), piecestoppos + 1)
-                    # if there are all the pieces, worth trying again!
-                    # But check if they are in order: sorted wont affect a strictly increasing list
-                    nextpieceorder.append(nextpiecepos)
-                    if not nextpieceorder==sorted(nextpieceorder):
-                        if debug>1:
-                            print("Next pieces are not ordered correctly")
-                    if not (nextpiecepos > 0) or not nextpieceorder==sorted(nextpieceorder):
-                        tryagainwhere = 0
-                        tryfindingbrokenneedle = False
-                        if debug > 1:
-                            print("Will not try again because " + str(tryagainwhere) + " for " + needle + "@" + nextpiece)
-                        break
-                    else:
-                        tryagainwhere = piecestoppos+1
-                        if debug > 1:
-                            print("Ready to try again past " + str(tryagainwhere) + " @ " + str( nextpiecepos) + " for " + needle + " @ " + nextpiece)
-
-                # all done, flush needle positions to start anew
-                # and also flush the pieces found when tryagainwhere
-                if tryagainwhere > 0:
-                    if debug > 1:
-                        print("Now trying again after flushing")
-                    piecesfound = {}
-                    p = 0
-                needlestartpos = None
-                previousneedlestoppos = needlestoppos
-                needlestoppos = None
-
-            # since we are looping on tryagainwhere being true, it must be set to false
-            # to stop when the last needle has been tried: do that by saving the current needle
-            previousneedle = needle
+                    for cur in range(needlestartpos, alternativesstop):
+                        currentalt = alternatives[cur]
+                        if currentalt is None:
+                            alternatives[cur] = [needle]
+                        else:
+                            # there is already something else: the list is always flat, so append to it
+                            # it can't be this needle, as its matches never overlap (see alternativesat)
+                            currentalt.append(needle)
 
     # In a separate function, we will refine the needles as the needles found
     # are subsetting, meaning NEW YORK and NEW YORK CITY will both match on "NEW YORK CITY"
@@ -489,6 +520,30 @@ def brokenneedlealgorithm(needles, haystack):
     return found, alternatives
 
 
+# The alternatives of a single position, computed from the needles found instead of
+# the full table: when only a few positions are ever looked at, there's no need for
+# the alternatives of every position of the haystack
+# Returns the same as alternatives[position]: None, or the needles found at this position,
+# in the order they were found
+# The matches of a needle never overlap and are in order (each new match is searched past
+# the previous one), so for each needle only the last match starting at or before the
+# position can contain it, and it is found by bisect
+# The matches are [start, len, stop] lists, compared item by item: [position, inf] comes after
+# all those starting at or before the position whatever their length, and before the others
+def alternativesat(found, position):
+    alternativesatposition = None
+    probe = [position, float("inf")]
+    for needle, needlepositions in found.items():
+        i = bisect_right(needlepositions, probe) - 1
+        # item 0 is the start, item 2 is the stop
+        if i >= 0 and needlepositions[i][2] >= position:
+            if alternativesatposition is None:
+                alternativesatposition = [needle]
+            else:
+                alternativesatposition.append(needle)
+    return alternativesatposition
+
+
 # The naive approach would be to go along the range, build a dict of matches
 # for each position, then using the dict, checking for range conflict:
 # in case of conflicting options, just decide which to keep by taking the longest
@@ -504,78 +559,84 @@ def brokenneedlealgorithm(needles, haystack):
 # The dict is built : at spot 0 (candidate 1 span 10) ... at position 2: candidate 5 span 15
 # Then naive logic is applied : 15>10 so starting at position 2, would purge candidate 1 from the candidates
 
-# input dict will be ordered:
-
-from collections import OrderedDict
+# Instead of comparing every span of every needle with every span of every other needle,
+# the spans are sorted once by start (then longest first) and swept from left to right:
+# everything before a span starts at or before it, so the span is a subset if one of these
+# (from another needle) stops at or after it. Only the furthest stop, and the furthest stop
+# of any other needle than that one, need to be kept during the sweep.
+# Identical spans from different needles are subsets of each other, so all of them go.
 
 def naiverefineneedles(subsettingneedles):
-    # shortest first
-    odsn = OrderedDict(sorted(subsettingneedles.items(), key=lambda t: len(t[0])))
-    # reversed: longest first
-    odsnr = OrderedDict(sorted(subsettingneedles.items(), key=lambda t: len(t[0]), reverse=True))
-
-
-    if debug > 1:
-        print(odsn)
-
-    for k in odsnr.keys():
-        a = odsnr[k]
+    # flatten all the spans: start, stop, needle, and a span id that is simply
+    # the order in which it was flattened, to remove it by index instead of by value
+    spans = []
+    for k, a in subsettingneedles.items():
         for v in a:
             # v is an array of values: arg0 start, arg1 len, arg3 pos
-            longstartpos = int(v[0])
             # cant just use startpos + len(k) as that would be forgetting some hay
-            longstoppos = int(v[2])
-            # if that span in present in the others, remove
-            for kk in odsn.keys():
-                # exception for self
-                if kk == k:
-                    if debug > 1:
-                        print("skipping self:" + str(kk))
-                else:
-                    aa = odsn[kk]
-                    for vv in aa:
-                        shortstartpos = int(vv[0])
-                        shortstoppos = int(vv[2])
-                        # test for full overlap of the short by the long
-                        if longstartpos <= shortstartpos and longstoppos >= shortstoppos:
-                            if debug > 1:
-                                print("keeping -> k=" + str(k) + "\t\t\tkk=" + str(kk) + " <- removing @ " +str(shortstartpos))
-                                print(str(longstartpos) + "<=?" + str(shortstartpos))
-                                print(str(longstoppos) + ">=?" + str(shortstoppos))
-                            # delete this overlap: remove short
-                            try:
-                                offsets = subsettingneedles[kk]
-                            except KeyError:
-                                # WONTFIX: shouldn't happen anymore as the list is only emptied at the end
-                                print ("ERROR on subsetting due to possibly empty offsets for " +str(kk))
-                                offsets=None
-
-                            if debug>2:
-                                print ("\t\t\t\t\tWas : " + str(offsets))
-                                print (str(vv[0]))
-
-                            if offsets is not None:
-                                # can easily filter with a list comprehension
-                                # for an array
-                                # offsetsclean= {o for o in offsets if o is not vv}
-                                # but this is more readable
-
-                                offsetsclean=[]
-                                for o in offsets:
-                                    if o[0] is not vv[0]:
-                                        offsetsclean.append(o)
-
-                                subsettingneedles[kk] = offsetsclean
-                                if debug>2:
-                                    print ("\t\t\t\t\tNow : " + str(offsetsclean))
-                            # WONTFIX: removing the empty parts from subsettingneedles right
-                            # here was not working correctly, and was causing the key errors
-
-    # So instead, clean the list once done
-    # An empty Set() was found with just "is not None"
-    nosubsettingneedles = {k: v for k, v in subsettingneedles.items() if v is not None and len(v)!=0}
-
-    return (nosubsettingneedles)
+            spans.append((v[0], v[2], k, len(spans)))
+    keep = [True] * len(spans)  # for each span id, whether the span is kept
+    spans.sort(key=lambda span: (span[0], -span[1]))
+
+    if __debug__ and debug > 1:
+        print(spans)
+
+    longeststop = -1  # the furthest stop seen so far
+    longestneedle = None  # and the needle it belongs to
+    otherstop = -1  # the furthest stop seen so far for any other needle than longestneedle
+    otherneedle = None
+
+    s = 0
+    while s < len(spans):
+        startpos, stoppos = spans[s][0], spans[s][1]
+        # group the identical spans together
+        t = s + 1
+        while t < len(spans) and spans[t][0] == startpos and spans[t][1] == stoppos:
+            t = t + 1
+        group = spans[s:t]
+        identical = len(set(span[2] for span in group)) > 1
+
+        for startpos, stoppos, k, i in group:
+            # exception for self: only a span from another needle can remove this one
+            if k == longestneedle:
+                longstoppos, kk = otherstop, otherneedle
+            else:
+                longstoppos, kk = longeststop, longestneedle
+            # test for full overlap of the short by the long
+            if identical or longstoppos >= stoppos:
+                if __debug__ and debug > 1:
+                    print(f"removing -> k={k} @ {startpos}:{stoppos} <- overlapped by kk={kk}")
+                keep[i] = False
+
+        # then they can overlap the next ones
+        for startpos, stoppos, k, i in group:
+            if stoppos > longeststop:
+                if k != longestneedle:
+                    otherstop, otherneedle = longeststop, longestneedle
+                longeststop, longestneedle = stoppos, k
+            elif k != longestneedle and stoppos > otherstop:
+                otherstop, otherneedle = stoppos, k
+        s = t
+
+    # remove the subsetting spans from their needles, in the same order they were flattened
+    firstspanid = 0
+    for k, a in subsettingneedles.items():
+        offsetsclean = [v for spanid, v in enumerate(a, firstspanid) if keep[spanid]]
+        firstspanid = firstspanid + len(a)
+        if len(offsetsclean) != len(a):
+            if __debug__ and debug > 2:
+                print(f"\t\t\t\t\tWas : {a}")
+                print(f"\t\t\t\t\tNow : {offsetsclean}")
+            subsettingneedles[k] = offsetsclean
+
+    # then drop the needles left without any span, in place as the spans already were
+    # Deleting while iterating over the dict raises an error, so list them first
+    # "not v" is True for both None and an empty list
+    deadneedles = [k for k, v in subsettingneedles.items() if not v]
+    for k in deadneedles:
+        del subsettingneedles[k]
+
+    return (subsettingneedles)
 
 
 # This is wrong, we can see why graphically: 3 non overlapping matches are possible:
@@ -613,7 +674,66 @@ def naiverefineneedles(subsettingneedles):
 # Ideally, we could be looking forward then looking backward to extend both ways,
 # which will cover both the prefixes and suffixes (YORK, NEW YORK and NEW YORK CITY
 # and WALES, SOUTH WALES, NEW SOUTH WALES)
+#
+# Better than looking forward and backward: it's the classic weighted interval scheduling.
+# Each span is an interval, weighted by how much of the haystack it covers, and among all
+# the sets of non overlapping intervals, pick the one covering the most, ie leaving the least hay.
+# Once the spans are sorted by where they stop, it can be built from left to right: the best
+# set up to a span either doesn't use it (same as the best up to the span before), or uses it
+# along with the best set up to the last span stopping before it starts (found by bisect)
+# In the example above, 1+2+3+4 covers 10+3+4+6=23 and is picked, while 5+4 only covers 13+6=19
+
+def intervalrefineneedles(subsettingneedles):
+    # flatten all the spans: stop, start, needle, and a span id that is simply
+    # the order in which it was flattened, then sort them by stop
+    spans = []
+    for k, a in subsettingneedles.items():
+        for v in a:
+            # v is an array of values: arg0 start, arg1 len, arg3 pos
+            spans.append((v[2], v[0], k, len(spans)))
+    spans.sort(key=lambda span: span[0])
+    stops = [span[0] for span in spans]
+
+    # best[i] is the most that can be covered with the first i spans (in stop order)
+    # and previous[i] how many spans are left to choose from when the span i is used
+    best = [0] * (len(spans) + 1)
+    previous = [0] * len(spans)
+    used = [False] * len(spans)
+    for i, (stoppos, startpos, k, spanid) in enumerate(spans):
+        # the spans stopping before this one starts can be used along with it
+        previous[i] = bisect_left(stops, startpos)
+        withspan = stoppos - startpos + 1 + best[previous[i]]
+        # on a tie, keep the spans already chosen
+        if withspan > best[i]:
+            best[i + 1] = withspan
+            used[i] = True
+        else:
+            best[i + 1] = best[i]
+
+    # then go back from the last span to find which were used
+    keep = [False] * len(spans)  # for each span id, whether the span is kept
+    i = len(spans)
+    while i > 0:
+        if used[i - 1]:
+            stoppos, startpos, k, spanid = spans[i - 1]
+            keep[spanid] = True
+            i = previous[i - 1]
+        else:
+            i = i - 1
+
+    if __debug__ and debug > 1:
+        print(f"Covering {best[-1]} positions with {keep.count(True)} spans out of {len(spans)}")
 
+    # keep the chosen spans of each needle, in the same order they were flattened
+    nooverlappingneedles = {}
+    firstspanid = 0
+    for k, a in subsettingneedles.items():
+        offsetsclean = [v for spanid, v in enumerate(a, firstspanid) if keep[spanid]]
+        firstspanid = firstspanid + len(a)
+        if offsetsclean:
+            nooverlappingneedles[k] = offsetsclean
+
+    return (nooverlappingneedles)
 
 
 # Takes as an input needles and a haystack, computes the refined needles,
@@ -621,350 +741,260 @@ def naiverefineneedles(subsettingneedles):
 # which does not depends on any regex and is thus less risky
 # Returns the recovered haystack, and the encoded haystack
 # where needles are replaced by their codes and an optional separator
+# With padded, each replacement is padded with spaces in front to the size of the span it
+# replaces, so that the positions in the haystack don't move: this is the delta.
 
-def brokenneedleapply(dictin, haystackin, separator_start, separator_stop):
-
-    needles, needlesalternatives = brokenneedlealgorithm(dictin, haystackin)
-    needlesrefined = naiverefineneedles(needles)
+def brokenneedleapply(dictin, haystackin, separator_start, separator_stop, padded=False):
 
-    # initialize
-    recovered=haystackin
-    needlesrefinedcopy=needlesrefined
+    # the alternatives are not used here, except to show them when debugging
+    needles, needlesalternatives = brokenneedlealgorithm(dictin, haystackin, withalternatives=__debug__ and debug>2)
 
-    # To keep track of needles already processed and not update their position, another dict
-    # only useful for debug purposes to avoid displaying an offset update that won't be used
-    needlesdone={}
-
-    if debug>1:
-        print("Needles refined:")
-        print(needlesrefined)
-
-    if debug>2:
+    if __debug__ and debug>2:
         print("Needles:")
         print(needles)
         print("Needles alternatives:")
         print(needlesalternatives)
 
-    for n in needlesrefined.keys():
-        if debug>2:
-            print("Needle is '" + str(n) + "'")
+    needlesrefined = naiverefineneedles(needles)
 
-        # FIXME: We assume a needle can only be present once.
-        # So fail, as this algorithm will need improvements to tolerate more offsets than one
-        if len(needlesrefined[n]) !=1:
-            print ("cardinality error on "  + str(n) + " found at " + str(needlesrefined[n]))
-            exit(1)
-        else:
-            [[sstart, slen, sstop]] = needlesrefined[n]
-
-        nstart=int(sstart)
-        nlen=int(slen)
-        nstop=int(sstop)
-
-        # Applying the needle means replacing a piece of text by another.
-        # It needs to take into account the size difference:
-        # Doing even one replacement may change the offsets of all subsequent needles
-        # So we compute the delta to alter them:
-        delta = len(n) - 1 -nstop +nstart
-        # We truncate to before, apply the string, truncate what's after, and glue it together
-        replaced= recovered[:nstart] +  str(n) + recovered[nstop+1:]
-
-        if debug>2:
-            print ("Delta=" + str(delta) +": len(n)=" +str(len(n)) + " -1 -nstop=" +str(nstop) + "+nstart=" + str(nstart) + "\n")
-            print("Gluing with delta=" +str(delta) + ":\n>" + str(recovered[:nstart]) + "<+>" + str(n) + "<+>" + str(recovered[nstop+1:]) +"\n")
-            print('replaced=' +str(replaced))
-
-        # For non zero delta, update the needles.
-        # Making a for loop within another for loop is NOT EFFICIENT: O(n^2), quadratic!
-        # HOWEVER it's easier to understand and maintain, and the performance loss may be acceptable
-        # since the number of refined needles will be very limited
-        if delta != 0:
-            if debug>2:
-                print("Tweaking needles position")
-            for m in needlesrefined.keys():
-                # this needlesdone is not really needed, except for debug purposes
-                if not n == m and not m in needlesdone.keys():
-                    [[tstart, tlen, tstop]] = needlesrefined[m]
-                    mstart = int(tstart)
-                    mlen = int(tlen)
-                    mstop = int(tstop)
-                    # For any other needle starting after the current one, update its offsets
-                    #if mstart > nstop:
-                    # But the stop of the needle can become less that nstop due to the delta!
-                    #if (mstart > nstart + len(n)):
-                    # HOWEVER, this doesn't matter: all that does is the start point!
-                    if mstart>nstart:
-                        if debug>2:
-                            print('needle ' + str(m) + ' was:' + str(needlesrefined[m]))
-                        mstartnew=mstart+delta
-                        mstopnew=mstop+delta
-                        mnew = [str(mstartnew), str(mlen),str(mstopnew)]
-                        needlesrefined[m]=[mnew]
-                        if debug>2:
-                            print('needle ' + str(m) + ' now:' + str(needlesrefined[m]))
-        # Apply the update for the next loop
-        recovered=replaced
-        # And mark the needle as processed so that we won't tweak (or show that we're tweaking) its offset
-        # Even if it wouldn't have practical consequences, it makes debugging easier
-        needlesdone[n]= needlesrefined[n]
-
-    # Now comes the encoding step, where we use the needle code
-    if debug>2:
-        print ("####################################\nNow encoding\n####################################\n")
-
-    # restore the haystack, as we did some replacements
-    encoded=haystackin
-    # restore the needles, as we did some tweaking on their positions
-    needlesrefined=needlesrefinedcopy
-    # restore the needles done, to help with debugging
-    needlesdone={}
-
-    # Exactly as above, except:
-    #  - nn (dictin[n] surrounded by the separator) replaces n in delta and replaced,
-    #  - the delta computation is different to take that code into account
-    for n in needlesrefined.keys():
-        [[sstart, slen, sstop ]] =needlesrefined[n]
-        nstart=int(sstart)
-        nlen=int(slen)
-        nstop=int(sstop)
+    if __debug__ and debug>1:
+        print("Needles refined:")
+        print(needlesrefined)
 
+    return brokenneedleapplyrefined(needlesrefined, dictin, haystackin, separator_start, separator_stop, padded)
+
+
+# The same, but for needles already found and refined, from the same haystack:
+# when they are already known, like in the examples, this avoids finding them twice
+
+def brokenneedleapplyrefined(needlesrefined, dictin, haystackin, separator_start, separator_stop, padded=False):
+
+    # checked once per needle in the loops below: a local is cheaper than looking up
+    # the global each time, and is read once so the level can't change halfway
+    verbose = __debug__ and debug > 1
+    veryverbose = __debug__ and debug > 2
+
+    # FIXME: We assume a needle can only be present once.
+    # So fail, as this algorithm will need improvements to tolerate more offsets than one
+    # All the needles in error are given at once, and as an exception instead of exiting,
+    # so a caller going through many haystacks can skip this one and go on with the others
+    cardinalityerrors = [f"{n!r} found at {npositions!r}" for n, npositions in needlesrefined.items() if len(npositions) != 1]
+    if cardinalityerrors:
+        raise ValueError("cardinality error on " + ", ".join(cardinalityerrors))
+
+    # Applying a needle means replacing a piece of text by another.
+    # Doing even one replacement changes the offsets of all the needles after it by its delta
+    # Instead of updating the offsets of all the other needles after each replacement
+    # (a for loop within another for loop: O(n^2), quadratic!) the needles are sorted
+    # by where they start, then applied from left to right.
+    # All that matters is the start point, as long as the needles starting before this one
+    # also stop before it.
+    # WONTFIX: the naive refinement only removes the needles contained in another, so two needles
+    # can still partly overlap (ex: CITY WALES and WALES SOUTH on CITY WALES SOUTH): both can't be
+    # replaced, so only the first one is, and the other one is skipped
+    # The offsets are never changed: they stay those of the haystack given, which is why
+    # the encoding step can use them as well. They are already ints, so they are simply
+    # put first in a tuple to sort them: start, len, stop, then the needle
+    needlesordered = sorted((sstart, slen, sstop, n) for n, [[sstart, slen, sstop]] in needlesrefined.items())
+
+    needlesnotoverlapping = []
+    previousstop = -1
+    for needleordered in needlesordered:
+        # item 0 is the start, item 2 is the stop
+        if needleordered[0] <= previousstop:
+            if verbose:
+                print(f"Needle '{needleordered[3]}' overlaps the needle before it, skipping it")
+        else:
+            needlesnotoverlapping.append(needleordered)
+            previousstop = needleordered[2]
+    needlesordered = needlesnotoverlapping
+
+    # As the needles are sorted and don't overlap, the haystack can be copied piece by piece
+    # into a list, and joined once at the end: gluing the whole string again for each needle
+    # would copy the haystack once per needle. It also means the offsets of the haystack can
+    # be used as they are, without tracking how much each replacement moved the ones after it.
+    # The recovered and the encoded strings use the same offsets, so both are built together:
+    #  - recovered gets the needle n,
+    #  - encoded gets nn (dictin[n] surrounded by the separator) instead of n
+    recoveredparts = []
+    encodedparts = []
+    # where the previous needle stopped, in the haystack
+    cursor = 0
+
+    for sstart, nlen, sstop, n in needlesordered:
         # Applying the needle means replacing a piece of text by another, surrounded by separators
-        nn = str(separator_start) + str(dictin[n]) + str(separator_stop)
-
-        # It needs to take into account the size difference:
-        # Doing even one replacement may change the offsets of all subsequent needles
-        # So we compute the delta, as before would be delta1:
-        #delta1=  nlen - 1 +nstart -nstop
-        # Except it would need to take into account delta 2:
-        #delta2 = len(str(nn)) - 1 - nstop + nstart
         # NEW','ORLEANS : haystack
-        # NEW ORLEANS   : delta1=-2  (between haystack and needle)
-        # 01              delta2=-9  (between needle and encoded needle)
-        #   123456789AB : delta =-11 (between haystack and encoded needle
-        # delta=delta2-delta1
-        # So we use directly the difference between the 2 entries:
-        delta= len(nn) -nlen
-
-        # We truncate to before, apply the string, truncate what's after, and glue it together
-        # Just as before, but nn instead of n
-        replaced= encoded[:nstart] + str(nn) + encoded[nstop+1:]
-
-        if debug>2:
-            print("Needle is '" + str(n) + "' when encoded is '" +str(separator_start) + str(dictin[n]) + str(separator_stop) + "', at nstart=" +str(nstart) + "\n")
-            print("Delta=" + str(delta) +": len(nn)=" +str(len(nn)) + " -nlen=" +str(nlen) + "\n")
-            print("Gluing encoded with delta=" +str(delta) + ":\n>" + str(encoded[:nstart]) + "<+>" + str(nn) + "<+>" + str(encoded[nstop+1:]) +"\n")
-            print("replaced encoded =" +str(replaced))
-
-        if delta != 0:
-            if debug>2:
-                print("Tweaking encoded needles position if needed")
-            for m in needlesrefined.keys():
-                if not n == m and not m in needlesdone.keys():
-                    [[tstart, tlen, tstop]] = needlesrefined[m]
-                    mstart = int(tstart)
-                    mlen = int(tlen)
-                    mstop = int(tstop)
-                    # For any other needle starting after the current one, update its offsets,
-                    # all that matters is the start position of each needle:
-                    if mstart>nstart:
-                        mstartnew=mstart+delta
-                        mstopnew=mstop+delta
-                        mnew = [str(mstartnew), str(mlen), str(mstopnew)]
-
-                        if debug > 2:
-                            print (str((mstart > nstart + len(dictin[n]))))
-                            print('needle encoded ' + str(m) + ' was:' + str(needlesrefined[m]))
-                            print('needle encoded ' + str(m) + ' now:' + str(mnew))
-
-                        needlesrefined[m]=[mnew]
-
-        # Apply the update for the next loop
-        encoded=replaced
-
-        # Add to the needles dones
-        needlesdone[n]=needlesrefined[n]
-
-        if debug > 2:
-            print('needles done ' + str(needlesdone[n]))
+        # NEW ORLEANS   : recovered needle
+        # {01}          : encoded needle
+        # the f-string converts the separators and the code to strings, the way str() did
+        nn = f"{separator_start}{dictin[n]}{separator_stop}"
+
+        if veryverbose:
+            print(f"Needle is '{n}' when encoded is '{nn}', at sstart={sstart}\n")
+            print(f"Gluing:\n>{haystackin[cursor:sstart]}<+>{n}< or >{nn}<\n")
+
+        # We take what's before, then the needle instead of what was in the haystack
+        hay = haystackin[cursor:sstart]
+        recoveredparts.append(hay)
+        encodedparts.append(hay)
+        if padded:
+            # After the cardinality check each needle is here only once, so it's padded only once:
+            # no need to keep the padded needles and codes for the next time they're found
+            # the span it replaces: from the start to the stop, both included
+            span = sstop - sstart + 1
+            recoveredparts.append(n.rjust(span, " "))
+            encodedparts.append(nn.rjust(span, " "))
+        else:
+            recoveredparts.append(n)
+            encodedparts.append(nn)
+        # and continue after it
+        cursor = sstop + 1
+
+    # what's after the last needle
+    hay = haystackin[cursor:]
+    recoveredparts.append(hay)
+    encodedparts.append(hay)
+    recovered = "".join(recoveredparts)
+    encoded = "".join(encodedparts)
+
+    if veryverbose:
+        print(f"recovered={recovered}")
+        print(f"encoded={encoded}")
 
     return (recovered,encoded)
 
-print("Distance tolerance for pieces:")
-print(piecedistancetolerance)
-print("Size required for pieces:")
-print(piecesizerequirement)
-
-f1, a1 = brokenneedlealgorithm(needlesgeo, haystackgeo1)
-print("Haystack used:")
-print(haystackgeo1)
-print("Needles found, with subsets:")
-print(f1)
-f1copy=f1.copy()
-g1 = naiverefineneedles(f1)
-print("Non subsetting neddles (naive approach):")
-print(g1)
-# to compare:
-if debug>2:
-    print("Remember: subsetting needles found:")
-    print(f1copy)
-
-print("Recovered haystack:")
-recover1=haystackgeo1
-for n in g1.keys():
-    [[sstart, slen, sstop ]] =g1[n]
-    nstart=int(sstart)
-    nlen=int(slen)
-    nstop=int(sstop)
-    # need to append spaces at the beginning in case the length differs
-    delta= nstop -nstart -nlen +1
-    replaced= delta*' ' + recover1[:nstart] + str(n) + recover1[nstop+1:]
-    recover1=replaced
-print(recover1)
-
-print ("Encoded haystack:")
-# the delta is why we use recover
-encoded1=recover1
-for n in g1.keys():
-    [[nstart, nlen, nstop ]] = g1[n]
-    value=needlesgeo[n]
-    leftpaddedvalue=value.rjust(int(nlen), " ")
-    replaced= encoded1[:int(nstart)] + str(leftpaddedvalue) + recover1[int(nstop)+1:]
-    encoded1=replaced
-print(encoded1)
-print ("Without spaces:")
-print(" ".join(encoded1.split()))
-
-print ("------------------------------")
-f2, a2 = brokenneedlealgorithm(needlesgeo, haystackgeo2)
-print("Haystack used:")
-print(haystackgeo2)
-print("Needles found, with subsets:")
-print(f2)
-f2copy=f2.copy()
-g2 = naiverefineneedles(f2)
-print("Non subsetting neddles (naive approach):")
-print(g2)
-if debug>2:
-    print("Remember: subsetting needles found:")
-    print(f2copy)
-
-# Manual recovery of the haystack
-if debug > 0:
-    a=a2
-    print("Alternatives per pos:")
-    print(a)
-    i = len(a)
-    print("Detail per position from 0 to " + str(i))
-    j = 0
-    while j < i:
-        print("@ " + str(j))
-        if a[j] is None:
-            print("None")
-            # next
-        else:
-            k = len(a[j])
-            l = 0
-            while l < k:
-                print(a[j][l])
-                l = l + 1
-        j = j + 1
-
-print("Recovered haystack:")
-recover2=haystackgeo2
-for n in g2.keys():
-    [[sstart, slen, sstop ]] =g2[n]
-    nstart=int(sstart)
-    nlen=int(slen)
-    nstop=int(sstop)
-    # need to append spaces at the beginning in case the length differs
-    delta= nstop -nstart -nlen +1
-    replaced= delta*' ' + recover2[:nstart] + str(n) + recover2[nstop+1:]
-    recover2=replaced
-print(recover2)
-
-print ("Encoded haystack:")
-# the delta is why we use recover
-encoded2=recover2
-for n in g2.keys():
-    [[nstart, nlen, nstop ]] = g2[n]
-    value=needlesgeo[n]
-    leftpaddedvalue=value.rjust(int(nlen), " ")
-    replaced= encoded2[:int(nstart)] + str(leftpaddedvalue) + recover2[int(nstop)+1:]
-    encoded2=replaced
-print(encoded2)
-print ("Without spaces:")
-print(" ".join(encoded2.split()))
-
-print ("Using the apply function:")
-haystackrecovered2,haystackencoded2=brokenneedleapply(needlesgeo,haystackgeo2,"{", "}")
-print(haystackrecovered2)
-print(haystackencoded2)
-
-print ("------------------------------")
-f3, a3 = brokenneedlealgorithm(needlesgeo, haystackgeo3)
-print("Haystack used:")
-print(haystackgeo3)
-print("Needles found, with subsets:")
-print(f3)
-f3copy=f3.copy()
-g3 = naiverefineneedles(f3)
-print("Non subsetting neddles (naive approach):")
-print(g3)
-if debug>2:
-    print("Remember: subsetting needles found:")
-    print(f3copy)
-
-# Manual recovery
-if debug > 0:
-    a=a3
-    print("Alternatives per pos:")
-    print(a)
-    i = len(a)
-    print("Detail per position from 0 to " + str(i))
-    j = 0
-    while j < i:
-        print("@ " + str(j))
-        if a[j] is None:
-            print("None")
-            # next
+
+# Show the alternatives found for each position of the haystack, to help with the manual recovery
+# as there are several lines per position, they are written all at once instead of printed one by one
+def printalternatives(alternatives):
+    lines = ["Alternatives per pos:", str(alternatives), f"Detail per position from 0 to {len(alternatives)}"]
+    for j, currentalt in enumerate(alternatives):
+        lines.append(f"@ {j}")
+        if currentalt is None:
+            lines.append("None")
         else:
-            k = len(a[j])
-            l = 0
-            while l < k:
-                print(a[j][l])
-                l = l + 1
-        j = j + 1
-
-print("Recovered haystack:")
-recover3=haystackgeo3
-for n in g3.keys():
-    [[sstart, slen, sstop ]] =g3[n]
-    nstart=int(sstart)
-    nlen=int(slen)
-    nstop=int(sstop)
-    # need to append spaces at the beginning in case the length differs
-    delta= nstop -nstart -nlen +1
-    replaced= recover3[:nstart] + delta*' ' +  str(n) + recover3[nstop+1:]
-    recover3=replaced
-print(recover3)
-
-# the delta is why we use recover
-encoded3=recover3
-print ("Encoded haystack:")
-for n in g3.keys():
-    [[sstart, slen, sstop ]] =g3[n]
-    nstart=int(sstart)
-    nlen=int(slen)
-    nstop=int(sstop)
-    value=needlesgeo[n]
-    leftpaddedvalue=value.rjust(nstop-nstart+1, " ")
-    replaced= encoded3[:int(nstart)] + str(leftpaddedvalue) + recover3[int(nstop)+1:]
-    encoded3=replaced
-print(encoded3)
-print ("Without spaces:")
-print(" ".join(encoded3.split()))
-
-print ("Using the apply function:")
-haystackrecovered3,haystackencoded3=brokenneedleapply(needlesgeo,haystackgeo3,"{", "}")
-print(haystackrecovered3)
-print(haystackencoded3)
+            lines.extend(currentalt)
+    lines.append("")
+    sys.stdout.write("\n".join(lines))
+
+
+# The examples: the 3 haystacks, from the vanilla to the most damaged one
+def main():
+    print("Distance tolerance for pieces:")
+    print(piecedistancetolerance)
+    print("Size required for pieces:")
+    print(piecesizerequirement)
+
+    f1, a1 = brokenneedlealgorithm(needlesgeo, haystackgeo1)
+    print("Haystack used:")
+    print(haystackgeo1)
+    print("Needles found, with subsets:")
+    print(f1)
+    # the interval scheduling doesn't change the needles found, unlike the naive approach
+    h1 = intervalrefineneedles(f1)
+    # so the needles found are only kept as they were if they will be shown
+    if debug > 2:
+        f1copy=f1.copy()
+    g1 = naiverefineneedles(f1)
+    print("Non subsetting neddles (naive approach):")
+    print(g1)
+    print("Non overlapping needles (interval scheduling):")
+    print(h1)
+    # to compare:
+    if debug>2:
+        print("Remember: subsetting needles found:")
+        print(f1copy)
+
+    print("Recovered haystack:")
+    # padded, and without separators, so the codes stay where the needles were in the haystack
+    recover1, encoded1 = brokenneedleapplyrefined(g1, needlesgeo, haystackgeo1, "", "", padded=True)
+    print(recover1)
+
+    print ("Encoded haystack:")
+    print(encoded1)
+    print ("Without spaces:")
+    print(" ".join(encoded1.split()))
+
+    print ("------------------------------")
+    f2, a2 = brokenneedlealgorithm(needlesgeo, haystackgeo2)
+    print("Haystack used:")
+    print(haystackgeo2)
+    print("Needles found, with subsets:")
+    print(f2)
+    # the interval scheduling doesn't change the needles found, unlike the naive approach
+    h2 = intervalrefineneedles(f2)
+    # so the needles found are only kept as they were if they will be shown
+    if debug > 2:
+        f2copy=f2.copy()
+    g2 = naiverefineneedles(f2)
+    print("Non subsetting neddles (naive approach):")
+    print(g2)
+    print("Non overlapping needles (interval scheduling):")
+    print(h2)
+    if debug>2:
+        print("Remember: subsetting needles found:")
+        print(f2copy)
+
+    # Manual recovery of the haystack
+    if debug > 0:
+        printalternatives(a2)
+
+    print("Recovered haystack:")
+    # padded, and without separators, so the codes stay where the needles were in the haystack
+    recover2, encoded2 = brokenneedleapplyrefined(g2, needlesgeo, haystackgeo2, "", "", padded=True)
+    print(recover2)
+
+    print ("Encoded haystack:")
+    print(encoded2)
+    print ("Without spaces:")
+    print(" ".join(encoded2.split()))
+
+    print ("Using the apply function:")
+    # the needles were already refined above, no need to find them again
+    haystackrecovered2,haystackencoded2=brokenneedleapplyrefined(g2,needlesgeo,haystackgeo2,"{", "}")
+    print(haystackrecovered2)
+    print(haystackencoded2)
+
+    print ("------------------------------")
+    f3, a3 = brokenneedlealgorithm(needlesgeo, haystackgeo3)
+    print("Haystack used:")
+    print(haystackgeo3)
+    print("Needles found, with subsets:")
+    print(f3)
+    # the interval scheduling doesn't change the needles found, unlike the naive approach
+    h3 = intervalrefineneedles(f3)
+    # so the needles found are only kept as they were if they will be shown
+    if debug > 2:
+        f3copy=f3.copy()
+    g3 = naiverefineneedles(f3)
+    print("Non subsetting neddles (naive approach):")
+    print(g3)
+    print("Non overlapping needles (interval scheduling):")
+    print(h3)
+    if debug>2:
+        print("Remember: subsetting needles found:")
+        print(f3copy)
+
+    # Manual recovery
+    if debug > 0:
+        printalternatives(a3)
+
+    print("Recovered haystack:")
+    # padded, and without separators, so the codes stay where the needles were in the haystack
+    recover3, encoded3 = brokenneedleapplyrefined(g3, needlesgeo, haystackgeo3, "", "", padded=True)
+    print(recover3)
+
+    print ("Encoded haystack:")
+    print(encoded3)
+    print ("Without spaces:")
+    print(" ".join(encoded3.split()))
+
+    print ("Using the apply function:")
+    # the needles were already refined above, no need to find them again
+    haystackrecovered3,haystackencoded3=brokenneedleapplyrefined(g3,needlesgeo,haystackgeo3,"{", "}")
+    print(haystackrecovered3)
+    print(haystackencoded3)
+
+
+if __name__ == "__main__":
+    main()